@@ -17,14 +17,23 @@ class StackBuild(StackTask):
     register('--watch',
              action='store_true',
              help='Watch for changes in local files and automatically rebuild.')
+    register('--batch', action='store_true', default=False,
+             help='Build all invalid Haskell projects that share a resolver with a single '
+                  '`stack` invocation, before collecting each project\'s executables with a '
+                  'cheap per-project `stack` run against the already built batch.')
 
   def execute(self):
     if self.get_options().watch:
       extra_args = ['--file-watch']
     else:
       extra_args = []
-    for target in self.context.target_roots:
-      with self.invalidated(targets=target.closure()) as invalidated:
-        for vt in invalidated.invalid_vts:
-          if self.is_haskell_project(vt.target):
-            self.stack_task('build', vt, extra_args)
+    if self.get_options().batch:
+      with self.invalidated(targets=self.context.targets()) as invalidated:
+        vts = [vt for vt in invalidated.invalid_vts if self.is_haskell_project(vt.target)]
+        self.batched_stack_task('build', vts, extra_args)
+    else:
+      for target in self.context.target_roots:
+        with self.invalidated(targets=target.closure()) as invalidated:
+          for vt in invalidated.invalid_vts:
+            if self.is_haskell_project(vt.target):
+              self.stack_task('build', vt, extra_args)
@@ -6,13 +6,17 @@ from __future__ import (absolute_import, division, generators, nested_scopes, pr
                         unicode_literals, with_statement)
 
 import os
-import subprocess
+from collections import OrderedDict, defaultdict
+from hashlib import sha1
+from itertools import chain
+
+from twitter.common.collections import OrderedSet
 
 from pants.base.build_environment import get_buildroot
 from pants.base.exceptions import TaskError
 from pants.base.workunit import WorkUnitLabel
 from pants.task.task import Task
-from pants.util.dirutil import safe_mkdir
+from pants.util.dirutil import safe_mkdir, safe_rmtree
 
 from pants.contrib.haskell.subsystems.stack_distribution import StackDistribution
 from pants.contrib.haskell.targets.haskell_hackage_package import HaskellHackagePackage
@@ -76,6 +80,27 @@ class StackTask(Task):
     """
     return isinstance(target, HaskellProject)
 
+  @staticmethod
+  def partition_packages(packages):
+    """Split targets into hackage, stackage and source packages in a single pass.
+
+    Targets that are not Haskell packages are dropped.
+
+    :param packages: The targets to partition.
+    :type packages: iterable of :class:`pants.build_graph.target.Target`
+    :returns: A `(hackage_packages, stackage_packages, source_packages)` tuple of lists.
+    :rtype: tuple
+    """
+    hackage_packages, stackage_packages, source_packages = [], [], []
+    for package in packages:
+      if isinstance(package, HaskellHackagePackage):
+        hackage_packages.append(package)
+      elif isinstance(package, HaskellStackagePackage):
+        stackage_packages.append(package)
+      elif isinstance(package, HaskellSourcePackage):
+        source_packages.append(package)
+    return hackage_packages, stackage_packages, source_packages
+
   @staticmethod
   def make_stack_yaml(target):
     """Build a `stack.yaml` file from a root target's dependency graph:
@@ -92,32 +117,55 @@ class StackTask(Task):
     :raises: :class:`pants.base.exceptions.TaskError` when the target's
              dependency graph specifies multiple different resolvers.
     """
-    packages = list(target.closure())
-    hackage_packages = filter(StackTask.is_haskell_hackage_package, packages)
-    source_packages  = filter(StackTask.is_haskell_source_package , packages)
+    hackage_packages, _, source_packages = StackTask.partition_packages(target.closure())
+    return StackTask.render_stack_yaml(target.resolver, hackage_packages, source_packages)
+
+  @staticmethod
+  def render_stack_yaml(resolver, hackage_packages, source_packages):
+    """Render the contents of a `stack.yaml` file for already partitioned packages.
 
-    yaml = 'flags: {}\n'
+    See `make_stack_yaml` for how each kind of package is translated.
+
+    :param str resolver: The `stack` resolver to use (i.e. "lts-3.1").
+    :param hackage_packages: The `HaskellHackagePackage` targets to build with.
+    :type hackage_packages: list of :class:`pants.build_graph.target.Target`
+    :param source_packages: The `HaskellSourcePackage` targets to build with.
+    :type source_packages: list of :class:`pants.build_graph.target.Target`
+    :returns: The string contents to use for the generated `stack.yaml` file.
+    :rtype: str
+    """
+    lines = ['flags: {}']
 
     if source_packages:
-      yaml += 'packages:\n'
+      lines.append('packages:')
+      buildroot = get_buildroot()
       for pkg in source_packages:
-        path = pkg.path or os.path.join(get_buildroot(), pkg.target_base)
-        yaml += '- ' + path + '\n'
+        path = pkg.path or os.path.join(buildroot, pkg.target_base)
+        lines.append('- {}'.format(path))
     else:
-      yaml += 'packages: []\n'
+      lines.append('packages: []')
 
     if hackage_packages:
-      yaml += 'extra-deps:\n'
+      lines.append('extra-deps:')
       for pkg in hackage_packages:
-        yaml += '- ' + pkg.package + '-' + pkg.version + '\n'
+        lines.append('- {}-{}'.format(pkg.package, pkg.version))
     else:
-      yaml += 'extra-deps: []\n'
+      lines.append('extra-deps: []')
+
+    lines.append('resolver: {}'.format(resolver))
 
-    yaml += 'resolver: ' + target.resolver + '\n'
+    return '\n'.join(lines) + '\n'
 
-    return yaml
+  @staticmethod
+  def package_names(hackage_packages, stackage_packages, source_packages):
+    """Return the names of already partitioned packages, to pass to `stack`.
 
-  def stack_task(self, command, vt, cmd_args = []):
+    :returns: The package names, hackage packages first and source packages last.
+    :rtype: list of strings
+    """
+    return [p.package for p in chain(hackage_packages, stackage_packages, source_packages)]
+
+  def stack_task(self, command, vt, cmd_args=None):
     """
     This function provides shared logic for all `StackTask` sub-classes, which
     consists of:
@@ -136,41 +184,146 @@ class StackTask(Task):
     :raises: :class:`pants.base.exceptions.TaskError` when the `stack`
              subprocess returns a non-zero exit code
     """
-    yaml = StackTask.make_stack_yaml(vt.target)
+    hackage_packages, stackage_packages, source_packages = StackTask.partition_packages(
+      vt.target.closure())
+    yaml = StackTask.render_stack_yaml(vt.target.resolver, hackage_packages, source_packages)
+    package_names = StackTask.package_names(hackage_packages, stackage_packages, source_packages)
+    stack_yaml_path = self._write_stack_yaml(vt.results_dir, yaml)
+    self._run_stack(command, stack_yaml_path, yaml, vt.results_dir, package_names, cmd_args,
+                    [vt.target])
+
+  def batched_stack_task(self, command, vts, cmd_args=None):
+    """Like `stack_task`, but builds several root targets that share a resolver together.
+
+    The targets are grouped by resolver, and each group is first built with a
+    single `stack` invocation from a `stack.yaml` covering the union of the
+    group's closures, so that `stack` can build their shared dependencies once.
+    The batch runs in a scratch directory under the task's workdir, keyed by the
+    merged manifest and the targets' cache keys, which is removed afterwards.
+
+    Each target then gets its own `stack.yaml` in its results directory, and
+    `stack` is run once more per target against the batch's (already built)
+    manifest with just that target's packages, so that its `bin/` subdirectory
+    holds exactly the executables a `stack_task` run would have produced.
+
+    Groups with a single target, and groups whose closures disagree about a
+    package (i.e. two different hackage versions of it), fall back to running
+    `stack_task` once per target.
+
+    :param str command: The `stack` sub-command to run (i.e. "build").
+    :param vts: The root targets that `stack` should operate on.
+    :type vts: list of :class:`pants.invalidation.cache_manager.VersionedTarget`
+    :param cmd_args: Additional flags to pass through to the `stack` subcommand.
+    :type cmd_args: list of strings
+    :raises: :class:`pants.base.exceptions.TaskError` when a `stack`
+             subprocess returns a non-zero exit code
+    """
+    vts_by_resolver = OrderedDict()
+    for vt in vts:
+      vts_by_resolver.setdefault(vt.target.resolver, []).append(vt)
+
+    for resolver, resolver_vts in vts_by_resolver.items():
+      if len(resolver_vts) == 1:
+        self.stack_task(command, resolver_vts[0], cmd_args)
+        continue
+
+      partitions = [StackTask.partition_packages(vt.target.closure()) for vt in resolver_vts]
+      hackage_packages, stackage_packages, source_packages = (OrderedSet(), OrderedSet(),
+                                                              OrderedSet())
+      for hackage, stackage, source in partitions:
+        hackage_packages.update(hackage)
+        stackage_packages.update(stackage)
+        source_packages.update(source)
+
+      conflicts = StackTask.conflicting_package_names(hackage_packages, stackage_packages,
+                                                      source_packages)
+      if conflicts:
+        self.context.log.debug('Building {} targets separately, since they disagree about: {}'
+                               .format(len(resolver_vts), ', '.join(conflicts)))
+        for vt in resolver_vts:
+          self.stack_task(command, vt, cmd_args)
+        continue
+
+      # Separate targets can still pin the same hackage package to the same version.
+      hackage_packages = OrderedDict((pkg.package, pkg) for pkg in hackage_packages).values()
+
+      yaml = StackTask.render_stack_yaml(resolver, hackage_packages, source_packages)
+      package_names = StackTask.package_names(hackage_packages, stackage_packages, source_packages)
+      batch_dir = self._batch_dir(yaml, resolver_vts)
+      try:
+        stack_yaml_path = self._write_stack_yaml(batch_dir, yaml)
+        self._run_stack(command, stack_yaml_path, yaml, batch_dir, package_names, cmd_args,
+                        [vt.target for vt in resolver_vts])
+
+        for vt, (hackage, stackage, source) in zip(resolver_vts, partitions):
+          self._write_stack_yaml(vt.results_dir,
+                                 StackTask.render_stack_yaml(resolver, hackage, source))
+          self._run_stack(command, stack_yaml_path, yaml, vt.results_dir,
+                          StackTask.package_names(hackage, stackage, source), cmd_args,
+                          [vt.target])
+      finally:
+        safe_rmtree(batch_dir)
 
-    stack_yaml_path = os.path.join(vt.results_dir, 'stack.yaml')
+  @staticmethod
+  def conflicting_package_names(hackage_packages, stackage_packages, source_packages):
+    """Return the names of packages that are specified in more than one way.
+
+    A package conflicts when it is pinned to different hackage versions, when
+    more than one source package provides it, or when it is provided by more
+    than one kind of package (i.e. taken from the resolver by one target and
+    pinned to a hackage version by another).
+
+    :returns: The sorted names of the conflicting packages.
+    :rtype: list of strings
+    """
+    specs_by_name = defaultdict(set)
+    for pkg in hackage_packages:
+      specs_by_name[pkg.package].add(('hackage', pkg.version))
+    for pkg in stackage_packages:
+      specs_by_name[pkg.package].add(('stackage',))
+    for pkg in source_packages:
+      specs_by_name[pkg.package].add(('source', pkg.address.spec))
+    return sorted(name for name, specs in specs_by_name.items() if len(specs) > 1)
+
+  def _batch_dir(self, yaml, vts):
+    hasher = sha1()
+    hasher.update(yaml.encode('utf-8'))
+    for vt in vts:
+      hasher.update(vt.cache_key.hash.encode('utf-8'))
+    batch_dir = os.path.join(self.workdir, 'batches', hasher.hexdigest())
+    safe_mkdir(batch_dir)
+    return batch_dir
+
+  @staticmethod
+  def _write_stack_yaml(results_dir, yaml):
+    stack_yaml_path = os.path.join(results_dir, 'stack.yaml')
     with open(stack_yaml_path, 'w') as handle:
       handle.write(yaml)
+    return stack_yaml_path
 
-    bin_path = os.path.join(vt.results_dir, 'bin')
+  def _run_stack(self, command, stack_yaml_path, yaml, results_dir, package_names, cmd_args,
+                 targets):
+    bin_path = os.path.join(results_dir, 'bin')
     safe_mkdir(bin_path)
 
-    packages = list(vt.target.closure())
-    hackage_packages  = filter(StackTask.is_haskell_hackage_package , packages)
-    stackage_packages = filter(StackTask.is_haskell_stackage_package, packages)
-    source_packages   = filter(StackTask.is_haskell_source_package  , packages)
-    haskell_packages = hackage_packages + stackage_packages + source_packages
-    haskell_package_names = map(lambda p: p.package, haskell_packages)
-
     stack_args = [
       '--local-bin-path', bin_path,
       '--stack-yaml', stack_yaml_path,
     ]
 
-    cmd_args = haskell_package_names + cmd_args
-
-    try:
-      stack_distribution = StackDistribution.Factory.create()
-      stack_distribution.execute_stack_cmd(
-        command,
-        stack_args=stack_args,
-        cmd_args=cmd_args,
-        workunit_factory=self.context.new_workunit,
-        workunit_name='stack-run',
-        workunit_labels=[WorkUnitLabel.TOOL],
-        )
-    except subprocess.CalledProcessError:
-      raise TaskError("""
+    cmd_args = package_names + list(cmd_args or ())
+
+    stack_distribution = StackDistribution.Factory.create()
+    returncode, _ = stack_distribution.execute_stack_cmd(
+      command,
+      stack_args=stack_args,
+      cmd_args=cmd_args,
+      workunit_factory=self.context.new_workunit,
+      workunit_name='stack-run',
+      workunit_labels=[WorkUnitLabel.TOOL],
+      )
+    if returncode != 0:
+      message = """
 `stack` subprocess failed with the following inputs:
 
 Arguments: {args}
@@ -181,8 +334,8 @@ Contents of {stack_yaml_path}:
 ```
 """.strip().format(stack_yaml_path=stack_yaml_path,
                    yaml=yaml,
-                   args=args))
-      raise
+                   args=' '.join(stack_args + cmd_args))
+      raise TaskError(message, exit_code=returncode, failed_targets=targets)
 
   def execute(self):
     pass
@@ -0,0 +1,200 @@
+# coding=utf-8
+# Copyright 2016 Pants project contributors (see CONTRIBUTORS.md).
+# Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+from __future__ import (absolute_import, division, generators, nested_scopes, print_function,
+                        unicode_literals, with_statement)
+
+import os
+
+import mock
+
+from pants.base.exceptions import TaskError
+from pants_test.tasks.task_test_base import TaskTestBase
+
+from pants.contrib.haskell.subsystems.stack_distribution import StackDistribution
+from pants.contrib.haskell.targets.haskell_hackage_package import HaskellHackagePackage
+from pants.contrib.haskell.targets.haskell_project import HaskellProject
+from pants.contrib.haskell.targets.haskell_source_package import HaskellSourcePackage
+from pants.contrib.haskell.targets.haskell_stackage_package import HaskellStackagePackage
+from pants.contrib.haskell.tasks.stack_build import StackBuild
+from pants.contrib.haskell.tasks.stack_task import StackTask
+
+
+class StackTaskTest(TaskTestBase):
+
+  @classmethod
+  def task_type(cls):
+    return StackBuild
+
+  def stack_distribution(self, returncode=0):
+    patcher = mock.patch.object(StackDistribution.Factory, 'create')
+    create = patcher.start()
+    self.addCleanup(patcher.stop)
+    stack_distribution = create.return_value
+
+    def execute_stack_cmd(cmd, stack_args=None, cmd_args=None, **kwargs):
+      # Emulate `stack` installing an executable for every package it was asked to build.
+      bin_path = stack_args[stack_args.index('--local-bin-path') + 1]
+      for package in cmd_args:
+        with open(os.path.join(bin_path, package), 'w') as fp:
+          fp.write(package)
+      return returncode, None
+    stack_distribution.execute_stack_cmd.side_effect = execute_stack_cmd
+    return stack_distribution
+
+  def make_project(self, name, resolver='lts-3.1', text=None):
+    """Make a project depending on its own source package and on some version of `text`."""
+    text = text or self.make_target(':{}-text'.format(name), HaskellHackagePackage,
+                                    package='text', version='1.2.1.1')
+    source = self.make_target(':{}-src'.format(name), HaskellSourcePackage)
+    return self.make_target(':{}'.format(name), HaskellProject, resolver=resolver,
+                            dependencies=[text, source])
+
+  def invalid_projects(self, invalidation_check):
+    return [vt for vt in invalidation_check.invalid_vts if StackTask.is_haskell_project(vt.target)]
+
+  def built_packages(self, stack_distribution):
+    return [sorted(call[1]['cmd_args'])
+            for call in stack_distribution.execute_stack_cmd.call_args_list]
+
+  def test_no_batch_by_default(self):
+    a = self.make_project('a')
+    b = self.make_project('b')
+    stack_distribution = self.stack_distribution()
+
+    self.create_task(self.context(target_roots=[a, b])).execute()
+    self.assertEqual([['a-src', 'text'], ['b-src', 'text']],
+                     self.built_packages(stack_distribution))
+
+  def test_batch_shared_resolver(self):
+    a = self.make_project('a')
+    b = self.make_project('b')
+    c = self.make_project('c', resolver='lts-3.2')
+    stack_distribution = self.stack_distribution()
+
+    task = self.create_task(self.context(target_roots=[a, b, c]))
+    with task.invalidated(targets=[a, b, c]) as invalidation_check:
+      vts = self.invalid_projects(invalidation_check)
+      task.batched_stack_task('build', vts)
+
+      # One batch for lts-3.1 followed by a run per project to collect its executables, and a
+      # plain run for c, which is alone on lts-3.2.
+      self.assertEqual([['a-src', 'b-src', 'text'],
+                        ['a-src', 'text'],
+                        ['b-src', 'text'],
+                        ['c-src', 'text']],
+                       self.built_packages(stack_distribution))
+
+      # Every project gets its own stack.yaml and only its own executables, just as if it had
+      # been built on its own.
+      for vt in vts:
+        with open(os.path.join(vt.results_dir, 'stack.yaml')) as fp:
+          self.assertEqual(StackTask.make_stack_yaml(vt.target), fp.read())
+        self.assertEqual(['{}-src'.format(vt.target.name), 'text'],
+                         sorted(os.listdir(os.path.join(vt.results_dir, 'bin'))))
+
+  def test_batch_conflicting_versions_builds_separately(self):
+    a = self.make_project('a')
+    b = self.make_project('b', text=self.make_target(':b-text', HaskellHackagePackage,
+                                                     package='text', version='1.2.2.0'))
+    stack_distribution = self.stack_distribution()
+
+    self.set_options(batch=True)
+    self.create_task(self.context(target_roots=[a, b])).execute()
+    self.assertEqual([['a-src', 'text'], ['b-src', 'text']],
+                     self.built_packages(stack_distribution))
+
+  def test_batch_stackage_and_hackage_builds_separately(self):
+    a = self.make_project('a', text=self.make_target(':a-text', HaskellStackagePackage,
+                                                     package='text'))
+    b = self.make_project('b')
+    stack_distribution = self.stack_distribution()
+
+    self.set_options(batch=True)
+    self.create_task(self.context(target_roots=[a, b])).execute()
+    self.assertEqual([['a-src', 'text'], ['b-src', 'text']],
+                     self.built_packages(stack_distribution))
+
+  def test_conflicting_package_names(self):
+    text = self.make_target(':text', HaskellHackagePackage, version='1.2.1.1')
+    same_text = self.make_target(':same-text', HaskellHackagePackage, package='text',
+                                 version='1.2.1.1')
+    other_text = self.make_target(':other-text', HaskellHackagePackage, package='text',
+                                  version='1.2.2.0')
+    stackage_text = self.make_target(':stackage-text', HaskellStackagePackage, package='text')
+    other_stackage_text = self.make_target(':other-stackage-text', HaskellStackagePackage,
+                                           package='text')
+    source_text = self.make_target(':source-text', HaskellSourcePackage, package='text')
+    other_source_text = self.make_target(':other-source-text', HaskellSourcePackage,
+                                         package='text')
+    aeson = self.make_target(':aeson', HaskellHackagePackage, version='0.9.0.1')
+
+    def conflicts(hackage=(), stackage=(), source=()):
+      return StackTask.conflicting_package_names(hackage, stackage, source)
+
+    self.assertEqual([], conflicts(hackage=[text, same_text, aeson]))
+    self.assertEqual([], conflicts(stackage=[stackage_text, other_stackage_text]))
+    self.assertEqual([], conflicts(hackage=[aeson], stackage=[stackage_text],
+                                   source=[source_text]))
+    self.assertEqual(['text'], conflicts(hackage=[text, other_text, aeson]))
+    self.assertEqual(['text'], conflicts(hackage=[text, aeson], stackage=[stackage_text]))
+    self.assertEqual(['text'], conflicts(hackage=[text], source=[source_text]))
+    self.assertEqual(['text'], conflicts(stackage=[stackage_text], source=[source_text]))
+    self.assertEqual(['text'], conflicts(source=[source_text, other_source_text]))
+
+  def test_batch_dir_keying(self):
+    a = self.make_project('a')
+    b = self.make_project('b')
+    self.stack_distribution()
+
+    task = self.create_task(self.context(target_roots=[a, b]))
+    with task.invalidated(targets=[a, b]) as invalidation_check:
+      vts = self.invalid_projects(invalidation_check)
+      batches_dir = os.path.join(task.workdir, 'batches')
+      batch_dir = task._batch_dir('resolver: lts-3.1\n', vts)
+      self.assertEqual(batches_dir, os.path.dirname(batch_dir))
+      self.assertTrue(os.path.isdir(batch_dir))
+      self.assertEqual(batch_dir, task._batch_dir('resolver: lts-3.1\n', vts))
+      self.assertNotEqual(batch_dir, task._batch_dir('resolver: lts-3.2\n', vts))
+      self.assertNotEqual(batch_dir, task._batch_dir('resolver: lts-3.1\n', vts[:1]))
+
+  def test_batch_dir_removed(self):
+    a = self.make_project('a')
+    b = self.make_project('b')
+    self.stack_distribution(returncode=1)
+
+    task = self.create_task(self.context(target_roots=[a, b]))
+    batches_dir = os.path.join(task.workdir, 'batches')
+    with self.assertRaises(TaskError) as cm:
+      with task.invalidated(targets=[a, b]) as invalidation_check:
+        task.batched_stack_task('build', self.invalid_projects(invalidation_check))
+    self.assertEqual([a, b], cm.exception.failed_targets)
+    self.assertEqual([], os.listdir(batches_dir))
+
+    stack_distribution = self.stack_distribution()
+    with task.invalidated(targets=[a, b]) as invalidation_check:
+      task.batched_stack_task('build', self.invalid_projects(invalidation_check))
+    self.assertEqual(3, stack_distribution.execute_stack_cmd.call_count)
+    self.assertEqual([], os.listdir(batches_dir))
+
+  def test_stack_failure_raises_task_error(self):
+    text = self.make_target(':text', HaskellHackagePackage, version='1.2.1.1')
+    project = self.make_target(':project', HaskellProject, resolver='lts-3.1',
+                               dependencies=[text])
+    self.stack_distribution(returncode=1)
+
+    task = self.create_task(self.context(target_roots=[project]))
+    with self.assertRaises(TaskError) as cm:
+      task.execute()
+
+    error = cm.exception
+    self.assertEqual(1, error.exit_code)
+    self.assertEqual([project], error.failed_targets)
+    message = str(error)
+    # The arguments passed to `stack`.
+    self.assertIn('--stack-yaml', message)
+    self.assertIn('text', message)
+    # The generated stack.yaml.
+    self.assertIn('- text-1.2.1.1', message)
+    self.assertIn('resolver: lts-3.1', message)
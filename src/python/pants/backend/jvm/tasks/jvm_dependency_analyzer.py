@@ -5,9 +5,11 @@
 from __future__ import (absolute_import, division, generators, nested_scopes, print_function,
                         unicode_literals, with_statement)
 
+import hashlib
 import os
 from abc import abstractmethod
-from collections import defaultdict
+from itertools import chain
+from multiprocessing.pool import ThreadPool
 
 from twitter.common.collections import OrderedSet
 
@@ -15,11 +17,12 @@ from pants.backend.jvm.targets.jvm_target import JvmTarget
 from pants.backend.jvm.targets.scala_library import ScalaLibrary
 from pants.backend.jvm.tasks.classpath_util import ClasspathUtil
 from pants.base.build_environment import get_buildroot
-from pants.build_graph.build_graph import sort_targets
+from pants.build_graph.build_graph import CycleException
 from pants.java.distribution.distribution import DistributionLocator
 from pants.task.task import Task
 from pants.util.contextutil import open_zip
-from pants.util.memo import memoized_property
+from pants.util.dirutil import safe_concurrent_create, safe_file_dump
+from pants.util.memo import memoized_method, memoized_property
 
 
 class JvmDependencyAnalyzer(Task):
@@ -29,12 +32,22 @@ class JvmDependencyAnalyzer(Task):
   determining which targets correspond to the actual source dependencies of any given target.
   """
 
+  # Upper bound on the threads used to scan jars for classfiles.
+  _MAX_JAR_SCAN_THREADS = 8
+
   @classmethod
   @abstractmethod
   def skip(cls, options):
     """Return true if the task should be entirely skipped, and thus have no product requirements."""
     pass
 
+  @classmethod
+  def register_options(cls, register):
+    super(JvmDependencyAnalyzer, cls).register_options(register)
+    register('--cache-bootstrap-classfiles', default=True, action='store_true',
+             help='Cache the classfiles found in the JVM bootstrap jars in the workdir, so they '
+                  'are only rescanned when the bootstrap jars change.')
+
   @classmethod
   def prepare(cls, options, round_manager):
     super(JvmDependencyAnalyzer, cls).prepare(options, round_manager)
@@ -44,60 +57,116 @@ class JvmDependencyAnalyzer(Task):
 
   @memoized_property
   def targets_by_file(self):
-    """Returns a map from abs path of source, class or jar file to an OrderedSet of targets.
+    """Returns a map from abs path of source, class or jar file to an ordered set of targets.
 
     The value is usually a singleton, because a source or class file belongs to a single target.
     However a single jar may be provided (transitively or intransitively) by multiple JarLibrary
     targets. But if there is a JarLibrary target that depends on a jar directly, then that
     "canonical" target will be the first one in the list of targets.
+
+    Singletons are represented by a (much lighter) one element frozenset, which is only promoted
+    to an OrderedSet once a second target claims the same file; both support iteration,
+    membership and `isdisjoint`.
     """
-    targets_by_file = defaultdict(OrderedSet)
+    targets_by_file = {}
+
+    def add_files(files, target):
+      for f in files:
+        targets = targets_by_file.get(f)
+        if targets is None:
+          targets_by_file[f] = frozenset((target,))
+        elif target not in targets:
+          if isinstance(targets, OrderedSet):
+            targets.add(target)
+          else:
+            targets_by_file[f] = OrderedSet(chain(targets, (target,)))
+
     runtime_classpath = self.context.products.get_data('runtime_classpath')
 
     # Compute src -> target.
     self.context.log.debug('Mapping sources...')
-    buildroot = get_buildroot()
+    # Sources are always relative to the (absolute) buildroot, so a plain prefix is enough and
+    # avoids an os.path.join call per source file.
+    buildroot_prefix = os.path.join(get_buildroot(), '')
     # Look at all targets in-play for this pants run. Does not include synthetic targets,
     for target in self.context.targets():
       if isinstance(target, JvmTarget):
-        for src in target.sources_relative_to_buildroot():
-          targets_by_file[os.path.join(buildroot, src)].add(target)
+        add_files([buildroot_prefix + src
+                   for src in target.sources_relative_to_buildroot()], target)
       # TODO(Tejal Desai): pantsbuild/pants/65: Remove java_sources attribute for ScalaLibrary
       if isinstance(target, ScalaLibrary):
         for java_source in target.java_sources:
-          for src in java_source.sources_relative_to_buildroot():
-            targets_by_file[os.path.join(buildroot, src)].add(target)
+          add_files([buildroot_prefix + src
+                     for src in java_source.sources_relative_to_buildroot()], target)
 
     # Compute classfile -> target and jar -> target.
     self.context.log.debug('Mapping classpath...')
     for target in self.context.targets():
-      # Classpath content.
-      files = ClasspathUtil.classpath_contents((target,), runtime_classpath)
-      # And jars; for binary deps, zinc doesn't emit precise deps (yet).
+      # Resolve the classpath once and derive both its content and its jars from it.
       cp_entries = ClasspathUtil.classpath((target,), runtime_classpath)
+      # Classfiles in the classpath content. Product deps are only ever sources, classfiles or
+      # jars, so directory and resource entries would never be looked up.
+      files = [f for f in ClasspathUtil.classpath_entries_contents(cp_entries)
+               if f.endswith('.class')]
+      # And jars; for binary deps, zinc doesn't emit precise deps (yet).
       jars = [cpe for cpe in cp_entries if ClasspathUtil.is_jar(cpe)]
-      for coll in [files, jars]:
-        for f in coll:
-          targets_by_file[f].add(target)
+      add_files(files, target)
+      add_files(jars, target)
 
     return targets_by_file
 
   def _jar_classfiles(self, jar_file):
-    """Returns an iterator over the classfiles inside jar_file."""
+    """Returns a tuple of the classfiles inside jar_file."""
     with open_zip(jar_file, 'r') as jar:
-      for cls in jar.namelist():
-        if cls.endswith(b'.class'):
-          yield cls
+      # Iterate the name index directly rather than copying it into a list via namelist().
+      return tuple(cls for cls in jar.NameToInfo if cls.endswith('.class'))
 
   @memoized_property
   def bootstrap_jar_classfiles(self):
-    """Returns a set of classfiles from the JVM bootstrap jars."""
-    bootstrap_jar_classfiles = set()
-    for jar_file in self._find_all_bootstrap_jars():
-      for cls in self._jar_classfiles(jar_file):
-        bootstrap_jar_classfiles.add(cls)
+    """Returns a set of classfiles from the JVM bootstrap jars.
+
+    Unless disabled, the result is cached in the workdir keyed by the paths, sizes and
+    modification times of the bootstrap jars, since it only changes along with the JDK.
+    """
+    bootstrap_jars = self._find_all_bootstrap_jars()
+    if not self.get_options().cache_bootstrap_classfiles:
+      return self._scan_jar_classfiles(bootstrap_jars)
+
+    cache_path = os.path.join(self.workdir, 'bootstrap_classfiles',
+                              self._fingerprint_jars(bootstrap_jars))
+    if os.path.isfile(cache_path):
+      with open(cache_path, 'rb') as fp:
+        return set(fp.read().decode('utf-8').splitlines())
+
+    bootstrap_jar_classfiles = self._scan_jar_classfiles(bootstrap_jars)
+
+    def write_cache(path):
+      safe_file_dump(path, '\n'.join(bootstrap_jar_classfiles).encode('utf-8'))
+    safe_concurrent_create(write_cache, cache_path)
     return bootstrap_jar_classfiles
 
+  @staticmethod
+  def _fingerprint_jars(jar_files):
+    hasher = hashlib.sha1()
+    for jar_file in jar_files:
+      stat = os.stat(jar_file)
+      hasher.update('{}:{}:{}\n'.format(jar_file, stat.st_size, stat.st_mtime).encode('utf-8'))
+    return hasher.hexdigest()
+
+  def _scan_jar_classfiles(self, jar_files):
+    """Returns a set of the classfiles found in all of the given jars."""
+    jar_classfiles = set()
+    if jar_files:
+      # Reading the jars is I/O bound, so scan them concurrently.
+      pool = ThreadPool(processes=min(len(jar_files), self._MAX_JAR_SCAN_THREADS))
+      try:
+        for classfiles in pool.map(self._jar_classfiles, jar_files, chunksize=1):
+          jar_classfiles.update(classfiles)
+      finally:
+        pool.close()
+        pool.join()
+    return jar_classfiles
+
   def _find_all_bootstrap_jars(self):
     def get_path(key):
       return DistributionLocator.cached().system_properties.get(key, '').split(':')
@@ -123,24 +192,51 @@ class JvmDependencyAnalyzer(Task):
     bootstrap_jars = filter(os.path.isfile, override_jars + boot_classpath + extension_jars)
     return bootstrap_jars  # Technically, may include loose class dirs from boot_classpath.
 
+  @memoized_method
   def _compute_transitive_deps_by_target(self):
-    """Map from target to all the targets it depends on, transitively."""
-    # Sort from least to most dependent.
-    sorted_targets = reversed(sort_targets(self.context.targets()))
-    transitive_deps_by_target = defaultdict(set)
-    # Iterate in dep order, to accumulate the transitive deps for each target.
-    for target in sorted_targets:
-      transitive_deps = set()
+    """Map from target to all the targets it depends on, transitively.
+
+    The map covers every target in play, so it is computed once and shared by all callers.
+    """
+    # Values are frozensets so that targets without dependencies can share a single empty set,
+    # and so that callers can't mutate the memoized result.
+    no_deps = frozenset()
+    transitive_deps_by_target = {}
+    visited = set()
+    path = OrderedSet()
+
+    # A single depth-first walk: each target's transitive deps are accumulated in post-order, once
+    # all of its dependencies have been visited, so no separate topological sort is needed.
+    def visit(target):
+      if target in path:
+        path_list = list(path)
+        cycle_head = path_list.index(target)
+        raise CycleException(path_list[cycle_head:] + [target])
+      if target in visited:
+        return
+      path.add(target)
       for dep in target.dependencies:
-        transitive_deps.update(transitive_deps_by_target.get(dep, []))
-        transitive_deps.add(dep)
+        visit(dep)
+      path.remove(target)
+      visited.add(target)
+
+      if target.dependencies:
+        # Build the frozenset straight from the dependencies' sets, without an intermediate set.
+        transitive_deps = frozenset(chain(target.dependencies,
+                                          *(transitive_deps_by_target.get(dep, no_deps)
+                                            for dep in target.dependencies)))
+      else:
+        transitive_deps = no_deps
 
       # Need to handle the case where a java_sources target has dependencies.
       # In particular if it depends back on the original target.
       if hasattr(target, 'java_sources'):
         for java_source_target in target.java_sources:
-          for transitive_dep in java_source_target.dependencies:
-            transitive_deps_by_target[java_source_target].add(transitive_dep)
+          transitive_deps_by_target[java_source_target] = transitive_deps_by_target.get(
+            java_source_target, no_deps).union(java_source_target.dependencies)
 
       transitive_deps_by_target[target] = transitive_deps
+
+    for target in self.context.targets():
+      visit(target)
     return transitive_deps_by_target
@@ -171,11 +171,13 @@ class JvmDependencyCheck(JvmDependencyAnalyzer):
 
     All paths in the input and output are absolute.
     """
+    bootstrap_jar_classfiles = self.bootstrap_jar_classfiles
+    java_home = DistributionLocator.cached().real_home
+
     def must_be_explicit_dep(dep):
       # We don't require explicit deps on the java runtime, so we shouldn't consider that
       # a missing dep.
-      return (dep not in self.bootstrap_jar_classfiles
-              and not dep.startswith(DistributionLocator.cached().real_home))
+      return dep not in bootstrap_jar_classfiles and not dep.startswith(java_home)
 
     def target_or_java_dep_in_targets(target, targets):
       # We want to check if the target is in the targets collection
@@ -190,21 +192,19 @@ class JvmDependencyCheck(JvmDependencyAnalyzer):
       else:
         return False
 
-    # TODO: If recomputing these every time becomes a performance issue, memoize for
-    # already-seen targets and incrementally compute for new targets not seen in a previous
-    # partition, in this or a previous chunk.
-    transitive_deps_by_target = self._compute_transitive_deps_by_target()
+    transitive_deps = self._compute_transitive_deps_by_target().get(src_tgt, frozenset())
 
     # Find deps that are actual but not specified.
     missing_file_deps = OrderedSet()  # (src, src).
     missing_tgt_deps_map = defaultdict(list)  # (tgt, tgt) -> a list of (src, src) as evidence.
     missing_direct_tgt_deps_map = defaultdict(list)  # The same, but for direct deps.
 
+    targets_by_file = self.targets_by_file
     buildroot = get_buildroot()
     abs_srcs = [os.path.join(buildroot, src) for src in src_tgt.sources_relative_to_buildroot()]
     for src in abs_srcs:
       for actual_dep in filter(must_be_explicit_dep, actual_deps.get(src, [])):
-        actual_dep_tgts = self.targets_by_file.get(actual_dep)
+        actual_dep_tgts = targets_by_file.get(actual_dep)
         # actual_dep_tgts is usually a singleton. If it's not, we only need one of these
         # to be in our declared deps to be OK.
         if actual_dep_tgts is None:
@@ -212,7 +212,7 @@ class JvmDependencyCheck(JvmDependencyAnalyzer):
         elif not target_or_java_dep_in_targets(src_tgt, actual_dep_tgts):
           # Obviously intra-target deps are fine.
           canonical_actual_dep_tgt = next(iter(actual_dep_tgts))
-          if actual_dep_tgts.isdisjoint(transitive_deps_by_target.get(src_tgt, [])):
+          if actual_dep_tgts.isdisjoint(transitive_deps):
             missing_tgt_deps_map[(src_tgt, canonical_actual_dep_tgt)].append((src, actual_dep))
           elif canonical_actual_dep_tgt not in src_tgt.dependencies:
             # The canonical dep is the only one a direct dependency makes sense on.
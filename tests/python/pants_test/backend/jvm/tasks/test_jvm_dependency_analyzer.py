@@ -0,0 +1,271 @@
+# coding=utf-8
+# Copyright 2016 Pants project contributors (see CONTRIBUTORS.md).
+# Licensed under the Apache License, Version 2.0 (see LICENSE).
+
+from __future__ import (absolute_import, division, generators, nested_scopes, print_function,
+                        unicode_literals, with_statement)
+
+import os
+from collections import defaultdict
+
+import mock
+from twitter.common.collections import OrderedSet
+
+from pants.backend.jvm.subsystems.scala_platform import ScalaPlatform
+from pants.backend.jvm.targets.jar_dependency import JarDependency
+from pants.backend.jvm.targets.jar_library import JarLibrary
+from pants.backend.jvm.targets.java_library import JavaLibrary
+from pants.backend.jvm.targets.scala_library import ScalaLibrary
+from pants.backend.jvm.tasks.classpath_products import ClasspathProducts
+from pants.backend.jvm.tasks.jvm_dependency_analyzer import JvmDependencyAnalyzer
+from pants.backend.jvm.tasks.jvm_dependency_check import JvmDependencyCheck
+from pants.build_graph.build_graph import CycleException, sort_targets
+from pants.util.contextutil import open_zip
+from pants.util.dirutil import safe_mkdir, touch
+from pants_test.subsystem.subsystem_util import subsystem_instance
+from pants_test.tasks.task_test_base import TaskTestBase
+
+
+def sort_targets_transitive_deps_by_target(targets):
+  """The `sort_targets` based computation that `_compute_transitive_deps_by_target` replaced."""
+  transitive_deps_by_target = defaultdict(set)
+  for target in reversed(sort_targets(targets)):
+    transitive_deps = set()
+    for dep in target.dependencies:
+      transitive_deps.update(transitive_deps_by_target.get(dep, []))
+      transitive_deps.add(dep)
+
+    if hasattr(target, 'java_sources'):
+      for java_source_target in target.java_sources:
+        for transitive_dep in java_source_target.dependencies:
+          transitive_deps_by_target[java_source_target].add(transitive_dep)
+
+    transitive_deps_by_target[target] = transitive_deps
+  return transitive_deps_by_target
+
+
+class JvmDependencyAnalyzerTest(TaskTestBase):
+
+  @classmethod
+  def task_type(cls):
+    return JvmDependencyCheck
+
+  def setUp(self):
+    super(JvmDependencyAnalyzerTest, self).setUp()
+    self.jdk_dir = os.path.join(self.build_root, 'jdk')
+    safe_mkdir(self.jdk_dir)
+
+  def create_jar(self, name, entries, jar_dir=None):
+    path = os.path.join(jar_dir or self.jdk_dir, name)
+    with open_zip(path, 'w') as jar:
+      for entry in entries:
+        jar.writestr(entry, b'')
+    return path
+
+  def create_analyzer(self, bootstrap_jars):
+    task = self.create_task(self.context())
+    task._find_all_bootstrap_jars = lambda: bootstrap_jars
+    return task
+
+  def bootstrap_cache_files(self):
+    cache_dir = os.path.join(self.test_workdir, 'bootstrap_classfiles')
+    return sorted(os.listdir(cache_dir)) if os.path.isdir(cache_dir) else []
+
+  def test_bootstrap_cache_miss_writes_cache(self):
+    jar = self.create_jar('rt.jar', ['java/', 'java/lang/Object.class', 'java/lang/String.class',
+                                     'META-INF/MANIFEST.MF'])
+    analyzer = self.create_analyzer([jar])
+
+    expected = {'java/lang/Object.class', 'java/lang/String.class'}
+    self.assertEqual(expected, analyzer.bootstrap_jar_classfiles)
+
+    cache_files = self.bootstrap_cache_files()
+    self.assertEqual([JvmDependencyAnalyzer._fingerprint_jars([jar])], cache_files)
+    with open(os.path.join(self.test_workdir, 'bootstrap_classfiles', cache_files[0])) as fp:
+      self.assertEqual(expected, set(fp.read().splitlines()))
+
+  def test_bootstrap_cache_hit_does_not_rescan(self):
+    jar = self.create_jar('rt.jar', ['java/lang/Object.class'])
+    self.assertEqual({'java/lang/Object.class'},
+                     self.create_analyzer([jar]).bootstrap_jar_classfiles)
+
+    with mock.patch.object(JvmDependencyAnalyzer, '_scan_jar_classfiles') as scan:
+      analyzer = self.create_analyzer([jar])
+      self.assertEqual({'java/lang/Object.class'}, analyzer.bootstrap_jar_classfiles)
+      self.assertFalse(scan.called)
+
+  def test_bootstrap_jar_change_changes_key(self):
+    jar = self.create_jar('rt.jar', ['java/lang/Object.class'])
+    original_key = JvmDependencyAnalyzer._fingerprint_jars([jar])
+    original_mtime = os.path.getmtime(jar)
+
+    os.utime(jar, (original_mtime + 10, original_mtime + 10))
+    touched_key = JvmDependencyAnalyzer._fingerprint_jars([jar])
+    self.assertNotEqual(original_key, touched_key)
+
+    # Same mtime, different size.
+    self.create_jar('rt.jar', ['java/lang/Object.class', 'java/lang/String.class'])
+    os.utime(jar, (original_mtime, original_mtime))
+    resized_key = JvmDependencyAnalyzer._fingerprint_jars([jar])
+    self.assertNotEqual(original_key, resized_key)
+    self.assertNotEqual(touched_key, resized_key)
+
+    self.assertEqual({'java/lang/Object.class', 'java/lang/String.class'},
+                     self.create_analyzer([jar]).bootstrap_jar_classfiles)
+    self.assertEqual([resized_key], self.bootstrap_cache_files())
+
+  def test_bootstrap_cache_disabled(self):
+    self.set_options(cache_bootstrap_classfiles=False)
+    jar = self.create_jar('rt.jar', ['java/lang/Object.class'])
+
+    self.assertEqual({'java/lang/Object.class'},
+                     self.create_analyzer([jar]).bootstrap_jar_classfiles)
+    self.assertEqual([], self.bootstrap_cache_files())
+
+    with mock.patch.object(JvmDependencyAnalyzer, '_scan_jar_classfiles',
+                           return_value={'java/lang/Object.class'}) as scan:
+      self.create_analyzer([jar]).bootstrap_jar_classfiles
+      self.assertTrue(scan.called)
+
+  def create_classes_dir(self, name, classfiles):
+    classes_dir = os.path.join(self.test_workdir, name)
+    for classfile in classfiles:
+      touch(os.path.join(classes_dir, classfile))
+    return classes_dir
+
+  def targets_by_file(self, classpath_by_target):
+    """Returns targets_by_file for targets with the given (target, classpath entries) pairs."""
+    context = self.context(target_roots=[target for target, _ in classpath_by_target])
+    runtime_classpath = context.products.get_data('runtime_classpath',
+                                                  ClasspathProducts.init_func(self.pants_workdir))
+    for target, entries in classpath_by_target:
+      runtime_classpath.add_for_target(target, [('default', entry) for entry in entries])
+    return self.create_task(context).targets_by_file
+
+  def make_jar_library(self, spec):
+    return self.make_target(spec, JarLibrary, jars=[JarDependency('org.example', 'lib', '1.0')])
+
+  def test_targets_by_file_single_owner(self):
+    a = self.make_java_target(spec=':a', sources=['A.java'])
+    classes_dir = self.create_classes_dir('a', ['com/example/A.class'])
+
+    targets_by_file = self.targets_by_file([(a, [classes_dir])])
+    self.assertEqual([a], list(targets_by_file[os.path.join(self.build_root, 'A.java')]))
+    self.assertEqual([a], list(targets_by_file['com/example/A.class']))
+
+  def test_targets_by_file_shared_jar(self):
+    jar = self.create_jar('lib.jar', ['org/example/Lib.class'], jar_dir=self.test_workdir)
+    canonical = self.make_jar_library(':canonical')
+    other = self.make_jar_library(':other')
+
+    targets_by_file = self.targets_by_file([(canonical, [jar]), (other, [jar])])
+    for path in (jar, 'org/example/Lib.class'):
+      self.assertIsInstance(targets_by_file[path], OrderedSet)
+      self.assertEqual([canonical, other], list(targets_by_file[path]))
+
+  def test_targets_by_file_same_target_twice(self):
+    a = self.make_java_target(spec=':a', sources=['A.java'])
+    # The same classfile name appears in two of the target's classpath entries.
+    classes_dir = self.create_classes_dir('a', ['com/example/A.class'])
+    other_classes_dir = self.create_classes_dir('a-other', ['com/example/A.class'])
+
+    targets = self.targets_by_file([(a, [classes_dir, other_classes_dir])])['com/example/A.class']
+    self.assertNotIsInstance(targets, OrderedSet)
+    self.assertEqual([a], list(targets))
+
+  def test_targets_by_file_value_types(self):
+    jar = self.create_jar('lib.jar', ['org/example/Lib.class'], jar_dir=self.test_workdir)
+    canonical = self.make_jar_library(':canonical')
+    other = self.make_jar_library(':other')
+    a = self.make_java_target(spec=':a', sources=['A.java'])
+    classes_dir = self.create_classes_dir('a', ['com/example/A.class'])
+
+    targets_by_file = self.targets_by_file([(canonical, [jar]), (other, [jar]),
+                                            (a, [classes_dir])])
+    singleton = targets_by_file['com/example/A.class']
+    shared = targets_by_file[jar]
+    self.assertIsInstance(singleton, frozenset)
+    self.assertIsInstance(shared, OrderedSet)
+
+    # Callers only rely on iteration, membership and isdisjoint, which both types support.
+    self.assertEqual(a, next(iter(singleton)))
+    self.assertEqual(canonical, next(iter(shared)))
+    self.assertIn(a, singleton)
+    self.assertNotIn(canonical, singleton)
+    self.assertIn(other, shared)
+    self.assertNotIn(a, shared)
+    self.assertTrue(singleton.isdisjoint(shared))
+    self.assertTrue(shared.isdisjoint(singleton))
+    self.assertFalse(singleton.isdisjoint({a}))
+    self.assertFalse(shared.isdisjoint({other}))
+
+  def test_targets_by_file_only_maps_classfiles(self):
+    classes_dir = self.create_classes_dir('a', ['com/example/Foo.class',
+                                                'com/example/app.properties'])
+    safe_mkdir(os.path.join(classes_dir, 'com/example/empty'))
+    jar = self.create_jar('lib.jar', ['org/', 'org/example/Lib.class', 'META-INF/MANIFEST.MF'],
+                          jar_dir=self.test_workdir)
+    a = self.make_java_target(spec=':a', sources=[])
+
+    targets_by_file = self.targets_by_file([(a, [classes_dir, jar])])
+    self.assertEqual({'com/example/Foo.class', 'org/example/Lib.class', jar}, set(targets_by_file))
+
+  def test_targets_by_file_missing_file(self):
+    a = self.make_java_target(spec=':a', sources=['A.java'])
+    targets_by_file = self.targets_by_file([(a, [])])
+
+    files = set(targets_by_file)
+    self.assertIsNone(targets_by_file.get('com/example/Missing.class'))
+    self.assertNotIn('com/example/Missing.class', targets_by_file)
+    self.assertEqual(files, set(targets_by_file))
+
+  def assert_transitive_deps_match_sort_targets(self, target_roots):
+    context = self.context(target_roots=target_roots)
+    transitive_deps_by_target = self.create_task(context)._compute_transitive_deps_by_target()
+
+    expected = sort_targets_transitive_deps_by_target(context.targets())
+    self.assertEqual({target: set(deps) for target, deps in expected.items()},
+                     {target: set(deps) for target, deps in transitive_deps_by_target.items()})
+    return transitive_deps_by_target
+
+  def make_java_target(self, *args, **kwargs):
+    return self.make_target(target_type=JavaLibrary, *args, **kwargs)
+
+  def test_transitive_deps_diamond(self):
+    d = self.make_java_target(spec=':d', sources=['d.java'])
+    b = self.make_java_target(spec=':b', sources=['b.java'], dependencies=[d])
+    c = self.make_java_target(spec=':c', sources=['c.java'], dependencies=[d])
+    a = self.make_java_target(spec=':a', sources=['a.java'], dependencies=[b, c])
+
+    transitive_deps_by_target = self.assert_transitive_deps_match_sort_targets([a])
+    self.assertEqual({b, c, d}, set(transitive_deps_by_target[a]))
+    self.assertEqual(set(), set(transitive_deps_by_target[d]))
+
+  def test_transitive_deps_java_sources(self):
+    with subsystem_instance(ScalaPlatform):
+      scala_runtime = self.make_target(':scala-library',
+                                       JarLibrary,
+                                       jars=[JarDependency('org.scala-lang', 'scala-library',
+                                                           '2.10.5')])
+      base = self.make_java_target(spec=':base', sources=['Base.java'])
+      scala = self.make_target(':scala',
+                               ScalaLibrary,
+                               sources=['Scala.scala'],
+                               dependencies=[base],
+                               java_sources=[':java'])
+      # The java_sources target depends back on the scala_library that owns it.
+      java = self.make_java_target(spec=':java', sources=['Java.java'], dependencies=[scala])
+      user = self.make_java_target(spec=':user', sources=['User.java'], dependencies=[scala])
+
+    transitive_deps_by_target = self.assert_transitive_deps_match_sort_targets([user, java])
+    self.assertEqual({scala, base, scala_runtime}, set(transitive_deps_by_target[java]))
+    self.assertEqual({scala, base, scala_runtime}, set(transitive_deps_by_target[user]))
+
+  def test_transitive_deps_cycle(self):
+    a = self.make_java_target(spec=':a', sources=['a.java'])
+    b = self.make_java_target(spec=':b', sources=['b.java'], dependencies=[a])
+    self.build_graph.inject_dependency(a.address, b.address)
+
+    task = self.create_task(self.context(target_roots=[b]))
+    with self.assertRaises(CycleException):
+      task._compute_transitive_deps_by_target()